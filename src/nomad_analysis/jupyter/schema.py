@@ -33,10 +33,16 @@ Upcoming features:
 - Write the analysis results back to the output section.
 """
 
+import functools
+import hashlib
+import json
 import os
+from collections.abc import Iterator
+from string import Template
 from typing import TYPE_CHECKING, Union
 
 import nbformat as nbf
+from nomad.datamodel.context import ServerContext
 from nomad.datamodel.data import (
     ArchiveSection,
     EntryData,
@@ -66,6 +72,7 @@ from nomad.metainfo import (
 from nomad_analysis.utils import (
     create_unique_filename,
     get_function_source,
+    get_reference,
     list_to_string,
 )
 
@@ -79,6 +86,117 @@ if TYPE_CHECKING:
 
 m_package = SchemaPackage()
 
+# Sources of the pre-defined cells. The dynamic parts are substituted when the cells
+# are written, the function sources are passed as values and are never parsed as
+# templates themselves.
+_INTRO_CELL = (
+    '# Pre-defined block\n'
+    '\n'
+    '# This notebook has been generated by "Jupyter Notebook Analysis" '
+    'schema.\n'
+    '# It gets the data from the entries referenced in the `inputs` '
+    'sub-section.\n'
+    '# It also gets the analysis function based on the analysis type '
+    '(e.g., XRD).'
+)
+_GENERIC_CELL_TEMPLATE = Template(
+    '# Pre-defined block\n'
+    '\n'
+    'analysis_entry_id = "${entry_id}"\n'
+    '\n'
+    '${generic_funcs}'
+    'analysis = get_analysis_entry(analysis_entry_id)\n'
+    'analysis\n'
+)
+_ANALYSIS_TYPE_CELL_TEMPLATE = Template(
+    '# Pre-defined block\n'
+    '\n'
+    '# Analysis functions specific to "${analysis_type}".\n'
+    '\n'
+    '${type_funcs}'
+)
+_XRD_CELL = '# Pre-defined block\n\nxrd_voila_analysis(input_data)\n'
+
+
+@functools.cache
+def _cached_category_source(category_name: str) -> str:
+    """
+    Returns the source code of the analysis functions of a category as a single
+    string. Cached as the analysis functions do not change during a process.
+
+    Args:
+        category_name (str): Category of the analysis functions.
+
+    Returns:
+        str: Source code of the analysis functions.
+    """
+    return list_to_string(get_function_source(category_name=category_name))
+
+
+def _predefined_cells_manifest(cells: list) -> dict:
+    """
+    Describes the pre-defined cells of a notebook by their number and a digest of
+    their source. Stored in the notebook metadata to detect unchanged cells.
+
+    Args:
+        cells (list): The pre-defined cells.
+
+    Returns:
+        dict: The number of cells and the md5 hex digest of their source.
+    """
+    digest = hashlib.md5(usedforsecurity=False)
+    for cell in cells:
+        digest.update(cell.source.encode())
+        digest.update(b'\0')
+    return {'predefined_cells': len(cells), 'predefined_digest': digest.hexdigest()}
+
+
+def normalize_m_proxy_value(m_proxy_value: str) -> str:
+    """
+    Normalize the m_proxy_value by adding forward slash in the beginning of section
+    path. For e.g., '../uploads/1234/archive/5678#data' will be modified to
+    '../uploads/1234/archive/5678#/data'.
+
+    Args:
+        m_proxy_value (str): The m_proxy_value to be normalized.
+
+    Returns:
+        str: The normalized m_proxy_value.
+    """
+    entry_path, separator, section_path = m_proxy_value.rpartition('#')
+    if not separator or section_path.startswith('/'):
+        return m_proxy_value
+    return f'{entry_path}#/{section_path}'
+
+
+def get_unique_reference_indices(
+    m_proxy_values: list[str], lab_ids: list[Union[str, None]]
+) -> list[int]:
+    """
+    Finds the references which are not duplicates of a previous reference. A reference
+    is a duplicate if its m_proxy_value or its lab_id (if available) was seen before.
+
+    Args:
+        m_proxy_values (list[str]): The m_proxy_values of the references.
+        lab_ids (list[Union[str, None]]): The lab_ids of the references.
+
+    Returns:
+        list[int]: The indices of the unique references, in their original order.
+    """
+    seen_proxy_values = set()
+    seen_lab_ids = set()
+    unique_indices = []
+    for index, (m_proxy_value, lab_id) in enumerate(zip(m_proxy_values, lab_ids)):
+        if m_proxy_value in seen_proxy_values:
+            continue
+        if lab_id is not None and lab_id in seen_lab_ids:
+            continue
+        seen_proxy_values.add(m_proxy_value)
+        if lab_id is not None:
+            seen_lab_ids.add(lab_id)
+        unique_indices.append(index)
+    return unique_indices
+
 
 class ReferencedEntry(ArchiveSection):
     """
@@ -128,16 +246,6 @@ class JupyterAnalysisResult(AnalysisResult):
         description='Status of connection with Jupyter notebook',
     )
 
-    def normalize(self, archive: 'EntryArchive', logger: 'BoundLogger'):
-        """
-        The normalize function for `JupyterAnalysisResult` section.
-
-        Args:
-            archive (EntryArchive): The archive containing the section.
-            logger (BoundLogger): A structlog logger.
-        """
-        super().normalize(archive, logger)
-
 
 class JupyterAnalysis(Analysis):
     """
@@ -154,16 +262,6 @@ class JupyterAnalysis(Analysis):
         description='The result section for the analysis',
     )
 
-    def normalize(self, archive: 'EntryArchive', logger: 'BoundLogger'):
-        """
-        The normalize function for `JupyterAnalysis` section.
-
-        Args:
-            archive (EntryArchive): The archive containing the section.
-            logger (BoundLogger): A structlog logger.
-        """
-        super().normalize(archive, logger)
-
 
 class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
     """
@@ -176,7 +274,7 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
         a_eln=ELNAnnotation(
             properties=SectionProperties(
                 visible=Filter(
-                    exclude=['input_entry_class'],
+                    exclude=['input_entry_class', 'query_for_inputs_fingerprint'],
                 ),
                 order=[
                     'name',
@@ -251,6 +349,27 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
             component=ELNComponentEnum.StringEditQuantity,
         ),
     )
+    query_for_inputs_fingerprint = Quantity(
+        type=str,
+        description="""
+        Fingerprint of `query_for_inputs` when its entries were last added as inputs.
+        Used to skip resolving the query entries if the query has not changed.
+        """,
+    )
+
+    def get_query_for_inputs_fingerprint(self) -> Union[str, None]:
+        """
+        Computes a fingerprint of `query_for_inputs` which is stable across processes.
+
+        Returns:
+            Union[str, None]: The md5 hex digest of the query or None if not set.
+        """
+        if self.query_for_inputs is None:
+            return None
+        return hashlib.md5(
+            json.dumps(self.query_for_inputs, sort_keys=True, default=str).encode(),
+            usedforsecurity=False,
+        ).hexdigest()
 
     def set_jupyter_notebook_name(
         self, archive: 'EntryArchive', logger: 'BoundLogger'
@@ -262,6 +381,15 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
             archive (EntryArchive): The archive containing the section.
             logger (BoundLogger): A structlog logger.
         """
+        if (
+            not self.name
+            and self.notebook is not None
+            and self.notebook.startswith('untitled_')
+            and self.notebook.endswith('.ipynb')
+        ):
+            # an untitled notebook keeps its file name until a name is set
+            return
+
         if self.name:
             file_name = (
                 self.name.replace(' ', '_')
@@ -279,40 +407,40 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
             return
 
         if self.notebook != file_name:
-            raw_path = archive.m_context.raw_path()
-            os.rename(
-                os.path.join(raw_path, self.notebook),
-                os.path.join(raw_path, file_name),
-            )
-            archive.m_context.process_updated_raw_file(file_name, allow_modify=True)
+            # the notebook might not be written yet, e.g. if `reset_notebook` is False
+            if archive.m_context.raw_path_exists(self.notebook):
+                raw_path = archive.m_context.raw_path()
+                os.rename(
+                    os.path.join(raw_path, self.notebook),
+                    os.path.join(raw_path, file_name),
+                )
+                archive.m_context.process_updated_raw_file(file_name, allow_modify=True)
             self.notebook = file_name
 
-    def get_resolved_section(
+    def get_upload_context(
         self,
-        m_proxy_value: str,
         upload_id: str,
         archive: 'EntryArchive',
         logger: 'BoundLogger',
-    ) -> Union['ArchiveSection', None]:
+    ) -> Union[ServerContext, None]:
         """
-        Get the resolved reference of the input entry class.
+        Get the server context of an upload, which is used to resolve references to
+        the entries of the upload.
 
         Args:
-            m_proxy_value (str): The m_proxy_value of the reference.
-            upload_id (str): The upload_id of the reference.
+            upload_id (str): The upload_id of the upload.
             archive (EntryArchive): The archive containing the section.
             logger (BoundLogger): A structlog logger.
 
         Returns:
-            Union[ArchiveSection, None]: The resolved archive or None.
+            Union[ServerContext, None]: The context of the upload or None.
         """
+        # imports from the app are deferred to keep the API stack out of schema loading
         from nomad.app.v1.models.models import User
         from nomad.app.v1.routers.uploads import get_upload_with_read_access
-        from nomad.datamodel.context import ServerContext
 
         try:
-            reference = SectionReference(reference=m_proxy_value)
-            context = ServerContext(
+            return ServerContext(
                 get_upload_with_read_access(
                     upload_id,
                     User(
@@ -321,6 +449,40 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
                     ),
                 )
             )
+        except Exception as e:
+            logger.warning(f'Could not get the context of the upload {upload_id}.\n{e}')
+
+        return None
+
+    def get_resolved_section(
+        self,
+        m_proxy_value: str,
+        upload_id: str,
+        archive: 'EntryArchive',
+        logger: 'BoundLogger',
+        context: ServerContext = None,
+    ) -> Union['ArchiveSection', None]:
+        """
+        Get the resolved reference of the input entry class.
+
+        Args:
+            m_proxy_value (str): The m_proxy_value of the reference.
+            upload_id (str): The upload_id of the reference.
+            archive (EntryArchive): The archive containing the section.
+            logger (BoundLogger): A structlog logger.
+            context (ServerContext, optional): The context of the upload. If not
+                provided, it is created from the `upload_id`.
+
+        Returns:
+            Union[ArchiveSection, None]: The resolved archive or None.
+        """
+        if context is None:
+            context = self.get_upload_context(upload_id, archive, logger)
+            if context is None:
+                return None
+
+        try:
+            reference = SectionReference(reference=m_proxy_value)
             reference.reference.m_proxy_context = context
             return reference.reference
 
@@ -329,11 +491,34 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
 
         return None
 
+    def iter_new_query_entries(self) -> Iterator[tuple[str, str]]:
+        """
+        Iterates over the entries of `query_for_inputs` which are not yet referenced
+        in the inputs, so that only new entries need to be resolved.
+
+        Yields:
+            tuple[str, str]: The upload_id and entry_id of the entry.
+        """
+        if self.query_for_inputs is None:
+            return
+        referenced = {
+            normalize_m_proxy_value(input_ref.reference.m_proxy_value)
+            for input_ref in self.inputs
+            if input_ref.reference is not None
+        }
+        for entry in self.query_for_inputs.get('data', []):
+            upload_id = entry['upload_id']
+            entry_id = entry['entry_id']
+            if get_reference(upload_id, entry_id) in referenced:
+                continue
+            yield upload_id, entry_id
+
     def process_query_for_inputs(
         self, archive: 'EntryArchive', logger: 'BoundLogger'
     ) -> list[ReferencedEntry]:
         """
-        Get the input entries based on the `query_for_inputs`.
+        Get the input entries based on the `query_for_inputs`. The context of each
+        upload is created only once and shared by all the entries of the upload.
 
         Args:
             archive (EntryArchive): The archive containing the section.
@@ -343,34 +528,63 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
             list[ReferencedEntry]: The list of input entries.
         """
         ref_list = []
-        entries = []
-
-        # extend the entries with the data from query_for_inputs
-        if self.query_for_inputs is not None:
-            entries.extend(self.query_for_inputs['data'])
+        contexts = {}
 
-        for entry in entries:
-            entry_id = entry['entry_id']
-            upload_id = entry['upload_id']
+        for upload_id, entry_id in self.iter_new_query_entries():
+            if upload_id not in contexts:
+                contexts[upload_id] = self.get_upload_context(
+                    upload_id, archive, logger
+                )
+            if contexts[upload_id] is None:
+                continue
+            m_proxy_value = get_reference(upload_id, entry_id)
             resolved_section = self.get_resolved_section(
-                f'../uploads/{upload_id}/archive/{entry_id}#/data',
-                entry['upload_id'],
+                m_proxy_value,
+                upload_id,
                 archive,
                 logger,
+                context=contexts[upload_id],
             )
             if resolved_section is None:
                 continue
             ref = ReferencedEntry(
-                m_proxy_value=f'../uploads/{upload_id}/archive/{entry_id}#/data',
                 name=resolved_section.get('name'),
                 lab_id=resolved_section.get('lab_id'),
             )
+            # `m_` prefixed keyword arguments are ignored by the section constructor
+            ref.m_proxy_value = m_proxy_value
             if resolved_section.get('lab_id') is not None:
                 ref.name = resolved_section.get('lab_id')
             ref_list.append(ref)
 
         return ref_list
 
+    def process_changed_query_for_inputs(
+        self, archive: 'EntryArchive', logger: 'BoundLogger'
+    ) -> list[ReferencedEntry]:
+        """
+        Get the input entries based on the `query_for_inputs`, but only if the query
+        changed since its entries were last added or if `reset_notebook` is set.
+        The fingerprint of the query is only stored once all of its entries are
+        resolved, so that entries which failed to resolve are retried.
+
+        Args:
+            archive (EntryArchive): The archive containing the section.
+            logger (BoundLogger): A structlog logger.
+
+        Returns:
+            list[ReferencedEntry]: The list of input entries.
+        """
+        fingerprint = self.get_query_for_inputs_fingerprint()
+        if not self.reset_notebook and fingerprint == self.query_for_inputs_fingerprint:
+            return []
+
+        ref_list = self.process_query_for_inputs(archive, logger)
+        if len(ref_list) == sum(1 for _ in self.iter_new_query_entries()):
+            self.query_for_inputs_fingerprint = fingerprint
+
+        return ref_list
+
     def normalize_input_references(
         self,
         ref_list: list[ReferencedEntry] = None,
@@ -379,56 +593,26 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
         """
         Combines the existing input references with provided list of references.
         Filters out duplicates based on m_proxy_value and lab_id.
-        Sets the name of the input references.
+        Sets the name of the input references based on the lab_id or name of the
+        referenced section. If lab_id, it is preferred over the name. If both are
+        not available, the reference name remains the default: None.
         """
-
-        def normalize_m_proxy_value(m_proxy_value):
-            """
-            Normalize the m_proxy_value (in-place) by adding forward slash in the
-            beginning of section path. For e.g., '../uploads/1234/archive/5678#data'
-            will be modified to '../uploads/1234/archive/5678#/data'.
-
-            Args:
-                m_proxy_value (str): The m_proxy_value to be normalized.
-            """
-            try:
-                entry_path, section_path = m_proxy_value.split('#')
-                if not section_path.startswith('/'):
-                    return f'{entry_path}#/{section_path}'
-            except Exception as e:
-                logger.warning(
-                    f'Error in normalizing the m_proxy_value "{m_proxy_value}".\n{e}'
-                )
-            return m_proxy_value
-
-        def set_name_for_inputs():
-            """
-            Set the name of the input references based on the lab_id or name of the
-            referenced section. If lab_id, it is preferred over the name. If both are
-            not available, the reference name remains the default: None.
-            """
-            for input_ref in self.inputs:
-                if input_ref.name is not None:
-                    continue
-                if input_ref.reference.name is None:
-                    continue
-                if input_ref.reference.get('lab_id') is not None:
-                    input_ref.name = input_ref.reference.lab_id
-                elif input_ref.reference.get('name') is not None:
-                    input_ref.name = input_ref.reference.name
-
         if ref_list is None:
             ref_list = []
 
-        # add the existing input references
+        # add the existing input references, reading the referenced section only once
         for input_ref in self.inputs:
-            if input_ref.reference is None:
+            reference = input_ref.reference
+            if reference is None:
                 continue
-            ref = ReferencedEntry(
-                m_proxy_value=input_ref.reference.m_proxy_value,
-                name=input_ref.name,
-                lab_id=input_ref.reference.get('lab_id'),
-            )
+            lab_id = reference.get('lab_id')
+            name = input_ref.name
+            if name is None:
+                section_name = reference.get('name')
+                if section_name is not None:
+                    name = lab_id if lab_id is not None else section_name
+            ref = ReferencedEntry(name=name, lab_id=lab_id)
+            ref.m_proxy_value = reference.m_proxy_value
             ref_list.append(ref)
 
         # normalize m_proxy_value
@@ -436,23 +620,17 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
             ref.m_proxy_value = normalize_m_proxy_value(ref.m_proxy_value)
 
         # filter based on m_proxy_value, and lab_id (if available)
-        ref_hash_map = {}
-        filtered_ref_list = []
-        for ref in ref_list:
-            if ref.m_proxy_value in ref_hash_map:
-                continue
-            if ref.lab_id is not None and ref.lab_id in ref_hash_map.values():
-                continue
-            ref_hash_map[ref.m_proxy_value] = ref.lab_id
-            filtered_ref_list.append(ref)
+        unique_indices = get_unique_reference_indices(
+            [ref.m_proxy_value for ref in ref_list],
+            [ref.lab_id for ref in ref_list],
+        )
 
-        self.inputs = []
-        for ref in filtered_ref_list:
-            self.inputs.append(
-                SectionReference(reference=ref.m_proxy_value, name=ref.name)
+        self.inputs = [
+            SectionReference(
+                reference=ref_list[index].m_proxy_value, name=ref_list[index].name
             )
-
-        set_name_for_inputs()
+            for index in unique_indices
+        ]
 
     def write_predefined_cells(
         self, archive: 'EntryArchive', logger: 'BoundLogger'
@@ -464,55 +642,32 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
             archive (EntryArchive): The archive containing the section.
             logger (BoundLogger): A structlog logger.
         """
-        entry_ids = []
-        if self.inputs is not None:
-            for entry in self.inputs:
-                entry_ids.append(entry.reference.m_parent.entry_id)
-        if len(entry_ids) == 0:
+        if not any(entry.reference is not None for entry in self.inputs or []):
             logger.warning('No EntryArchive linked.')
 
-        cells = []
-
-        code = (
-            '# Pre-defined block\n'
-            '\n'
-            '# This notebook has been generated by "Jupyter Notebook Analysis" '
-            'schema.\n'
-            '# It gets the data from the entries referenced in the `inputs` '
-            'sub-section.\n'
-            '# It also gets the analysis function based on the analysis type '
-            '(e.g., XRD).'
-        )
-        cells.append(nbf.v4.new_code_cell(source=code))
-
-        generic_analysis_functions = get_function_source(category_name='Generic')
-        generic_analysis_functions = list_to_string(generic_analysis_functions)
-
-        code = (
-            '# Pre-defined block\n'
-            '\n'
-            f'analysis_entry_id = "{archive.entry_id}"\n'
-            '\n'
-            f'{generic_analysis_functions}'
-            'analysis = get_analysis_entry(analysis_entry_id)\n'
-            'analysis\n'
+        cells = [nbf.v4.new_code_cell(source=_INTRO_CELL)]
+
+        cells.append(
+            nbf.v4.new_code_cell(
+                source=_GENERIC_CELL_TEMPLATE.substitute(
+                    entry_id=archive.entry_id,
+                    generic_funcs=_cached_category_source('Generic'),
+                )
+            )
         )
-        cells.append(nbf.v4.new_code_cell(source=code))
 
         if self.analysis_type is not None and self.analysis_type != 'Generic':
-            comment = (
-                '# Pre-defined block\n'
-                '\n'
-                f'# Analysis functions specific to "{self.analysis_type}".\n'
-                '\n'
+            cells.append(
+                nbf.v4.new_code_cell(
+                    source=_ANALYSIS_TYPE_CELL_TEMPLATE.substitute(
+                        analysis_type=self.analysis_type,
+                        type_funcs=_cached_category_source(self.analysis_type),
+                    )
+                )
             )
-            analysis_functions = get_function_source(category_name=self.analysis_type)
-            code = list_to_string(analysis_functions)
-            cells.append(nbf.v4.new_code_cell(source=comment + code))
 
         if self.analysis_type == 'XRD':
-            code = '# Pre-defined block\n' '\n' 'xrd_voila_analysis(input_data)\n'
-            cells.append(nbf.v4.new_code_cell(source=code))
+            cells.append(nbf.v4.new_code_cell(source=_XRD_CELL))
 
         return cells
 
@@ -529,6 +684,7 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
         nb = nbf.v4.new_notebook()
 
         cells = self.write_predefined_cells(archive, logger)
+        nb['metadata']['nomad_analysis'] = _predefined_cells_manifest(cells)
 
         cells.append(nbf.v4.new_code_cell())
         cells.append(nbf.v4.new_code_cell())
@@ -550,33 +706,56 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
         Overwrites the Jupyter notebook to reset predefined cells while preserving the
         other user-defined cells.
 
+        The notebook metadata keeps the number and digest of the pre-defined cells
+        written last. If these cells are untouched, they are replaced in place. The
+        notebook is only written if its serialized content changes.
+
         Args:
             archive (EntryArchive): The archive containing the section.
             logger (BoundLogger): A structlog logger.
         """
         cells = self.write_predefined_cells(archive, logger)
+        manifest = _predefined_cells_manifest(cells)
 
         with archive.m_context.raw_file(self.notebook, 'r') as nb_file:
-            nb = nbf.read(nb_file, as_version=nbf.NO_CONVERT)
-
-        for cell in nb.cells:
-            if cell.source.startswith('# Pre-defined block'):
-                continue
-            cells.append(cell)
-
-        nb.cells = cells
+            nb_source = nb_file.read()
+        nb = nbf.reads(nb_source, as_version=nbf.NO_CONVERT)
+
+        old_manifest = nb['metadata'].get('nomad_analysis', {})
+        old_count = old_manifest.get('predefined_cells')
+        if (
+            old_count is not None
+            and _predefined_cells_manifest(nb.cells[:old_count]) == old_manifest
+        ):
+            if old_manifest == manifest:
+                return
+            nb.cells[:old_count] = cells
+        else:
+            for cell in nb.cells:
+                if cell.source.startswith('# Pre-defined block'):
+                    continue
+                cells.append(cell)
+            nb.cells = cells
 
+        nb['metadata']['nomad_analysis'] = manifest
         nb['metadata']['trusted'] = True
 
+        new_nb_source = nbf.writes(nb)
+        if not new_nb_source.endswith('\n'):
+            new_nb_source += '\n'
+        if new_nb_source == nb_source:
+            return
+
         with archive.m_context.raw_file(self.notebook, 'w') as nb_file:
-            nbf.write(nb, nb_file)
+            nb_file.write(new_nb_source)
         archive.m_context.process_updated_raw_file(self.notebook, allow_modify=True)
 
     def write_jupyter_notebook(
         self, archive: 'EntryArchive', logger: 'BoundLogger'
     ) -> None:
         """
-        Writes the Jupyter notebook based on the analysis type.
+        Writes the Jupyter notebook based on the analysis type. An existing notebook
+        is overwritten, otherwise a new one is generated.
 
         Args:
             archive (EntryArchive): The archive containing the section.
@@ -594,8 +773,9 @@ class ELNJupyterAnalysis(JupyterAnalysis, EntryData):
         super().normalize(archive, logger)
 
         self.set_jupyter_notebook_name(archive, logger)
+
         self.normalize_input_references(
-            self.process_query_for_inputs(archive, logger), logger
+            self.process_changed_query_for_inputs(archive, logger), logger
         )
 
         if self.reset_notebook:
@@ -21,18 +21,76 @@
 Utility functions for the analysis plugin.
 """
 
+import collections
+import functools
 import importlib
 import inspect
-import json
+import logging
+import posixpath
+import re
+import tempfile
+import zipfile
+from collections.abc import Iterator
 from typing import TYPE_CHECKING, Any
 
+import orjson
 import requests
-from nomad.client.api import Auth
 from nomad.datamodel import EntryArchive
+from nomad.utils import generate_entry_id
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 if TYPE_CHECKING:
+    from nomad.client.api import Auth
     from nomad.datamodel.data import MSection
 
+logger = logging.getLogger(__name__)
+
+_CATEGORY_DECORATOR_RE = re.compile(r'^@category\b[^\n]*\n', re.MULTILINE)
+_RAW_ENDPOINT_TEMPLATE = '{base_url}/uploads/{upload_id}/raw/{path}'
+_REFERENCE_TEMPLATE = '../uploads/{upload_id}/archive/{entry_id}#/data'
+
+
+@functools.cache
+def _get_session() -> requests.Session:
+    """
+    Returns the session for the requests to the NOMAD API. The session keeps the
+    connections alive and retries requests rejected by an unavailable server. It is
+    only created once the first request is sent.
+
+    Returns:
+        requests.Session: The session with pooled and retrying adapters.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503],
+            raise_on_status=False,
+        ),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+@functools.cache
+def _get_auth() -> 'Auth':
+    """
+    Returns the authentication for the requests to the NOMAD API. The instance is
+    shared, as it keeps the access token and refreshes it once it expires. The NOMAD
+    client is only imported once authentication is needed.
+
+    Returns:
+        Auth: The authentication based on the NOMAD client configuration.
+    """
+    from nomad.client.api import Auth
+
+    return Auth()
+
 
 def category(category_name: str = None) -> callable:
     """
@@ -50,6 +108,32 @@ def category(category_name: str = None) -> callable:
     return decorator
 
 
+def iter_function_source(
+    func: callable = None, category_name: str = None, module: object = None
+) -> Iterator[str]:
+    """
+    Yields the source code of function (or functions) based on name or category.
+    It looks up for the function in the specified module.
+
+    Args:
+        category (str): Category of the functions.
+        func (callable): Singular function whose source code is to be yielded.
+        module (str): Module which will be searched.
+            Default is `nomad_analysis.analysis_source`.
+
+    Yields:
+        str: Source code of a function.
+    """
+    if category_name is None and func is not None:
+        yield inspect.getsource(func)
+    if category_name is not None and func is None:
+        if module is None:
+            index = _get_category_index()
+        else:
+            index = _build_category_index(module)
+        yield from index.get(category_name, ())
+
+
 def get_function_source(
     func: callable = None, category_name: str = None, module: object = None
 ) -> list:
@@ -66,27 +150,44 @@ def get_function_source(
     Returns:
         list: List of source code of the functions.
     """
-    func_sources = []
-    if category_name is None and func is not None:
-        func_sources.append(inspect.getsource(func))
-    if category_name is not None and func is None:
-        if module is None:
-            module = importlib.import_module('nomad_analysis.analysis_source')
-        for _, obj in inspect.getmembers(module):
-            if (
-                inspect.isfunction(obj)
-                and hasattr(obj, 'category')
-                and obj.category == category_name
-            ):
-                func_source = ''
-                source_lines = inspect.getsourcelines(obj)[0]
-                for source_line in source_lines:
-                    # ignoring category decorator
-                    if source_line.startswith('@category'):
-                        continue
-                    func_source += source_line
-                func_sources.append(func_source)
-    return func_sources
+    return list(iter_function_source(func, category_name, module))
+
+
+@functools.cache
+def _get_category_index() -> dict[str, tuple]:
+    """
+    Builds the index of the function sources by category for
+    `nomad_analysis.analysis_source`. The result is cached as the source of the module
+    does not change during a process. Other modules are not cached, so that they are
+    not kept alive by the cache.
+
+    Returns:
+        dict[str, tuple]: Source code of the functions by category.
+    """
+    return _build_category_index(
+        importlib.import_module('nomad_analysis.analysis_source')
+    )
+
+
+def _build_category_index(module: object) -> dict[str, tuple]:
+    """
+    Collects the source code of the categorized functions in the module with a single
+    scan over its members.
+
+    Args:
+        module (object): Module which will be searched.
+
+    Returns:
+        dict[str, tuple]: Source code of the functions by category.
+    """
+    index = collections.defaultdict(list)
+    for obj in vars(module).values():
+        if inspect.isfunction(obj) and hasattr(obj, 'category'):
+            # ignoring category decorator
+            index[obj.category].append(
+                _CATEGORY_DECORATOR_RE.sub('', inspect.getsource(obj))
+            )
+    return {name: tuple(sources) for name, sources in index.items()}
 
 
 def list_to_string(list_instance: list) -> str:
@@ -99,12 +200,12 @@ def list_to_string(list_instance: list) -> str:
     Returns:
         str: String representation of the list.
     """
-    string = ''
-    for item in list_instance:
-        string += item + '\n'
-    return string
+    if not list_instance:
+        return ''
+    return '\n'.join(list_instance) + '\n'
 
 
+@functools.lru_cache(maxsize=4096)
 def get_reference(upload_id: str, entry_id: str) -> str:
     """
     Returns the proxy value for referencing an entry.
@@ -116,7 +217,7 @@ def get_reference(upload_id: str, entry_id: str) -> str:
     Returns:
         str: Proxy value of the form '../uploads/{upload_id}/archive/{entry_id}#/data'
     """
-    return f'../uploads/{upload_id}/archive/{entry_id}#/data'
+    return _REFERENCE_TEMPLATE.format(upload_id=upload_id, entry_id=entry_id)
 
 
 def create_entry_with_api(
@@ -143,7 +244,9 @@ def create_entry_with_api(
     Returns:
         str: proxy value of the form '../uploads/{upload_id}/archive/{entry_id}#/data'
     """
-    endpoint = base_url + f'/uploads/{upload_id}/raw/{path}'
+    endpoint = _RAW_ENDPOINT_TEMPLATE.format(
+        base_url=base_url, upload_id=upload_id, path=path
+    )
 
     params['file_name'] = file_name
     if 'wait_for_processing' not in params:
@@ -151,10 +254,7 @@ def create_entry_with_api(
     if 'overwrite_if_exists' not in params:
         params['overwrite_if_exists'] = True
 
-    if not isinstance(section, EntryArchive):
-        entry = EntryArchive(data=section)
-    else:
-        entry = section
+    entry = section if isinstance(section, EntryArchive) else EntryArchive(data=section)
 
     response = put_nomad_request(
         url=endpoint, json_dict=entry.m_to_dict(), params=params
@@ -168,13 +268,82 @@ def create_entry_with_api(
     return reference
 
 
+def create_entries_with_api(
+    sections: list['MSection'],
+    base_url: str,
+    upload_id: str,
+    file_names: list[str],
+    path: str = '',
+    **params,
+) -> list[str]:
+    """
+    Uses the NOMAD API endpoint `/uploads/{upload_id}/raw/{path}` to create entries
+    for the given NOMAD sections with a single request. The entries are sent as one
+    zip archive, which is extracted in the upload and processed together. If entries
+    already exist with the same names, they will be overwritten. Returns the proxy
+    values for referencing the entries.
+
+    Unlike `create_entry_with_api`, the request does not wait for the processing,
+    which NOMAD only supports for single files. The references are derived from the
+    upload ID and the paths of the entries.
+
+    Args:
+        sections (list[MSection]): The entry data sections to be used for entry
+            creation.
+        base_url (str): Base URL of the NOMAD installation.
+        upload_id (str): Upload ID of the upload in which the entries need to be
+            created.
+        file_names (list[str]): Names of the files to be created for the entries, in
+            the order of the sections.
+        path (str, Optional): Path in the NOMAD upload where the entries will be
+            created.
+        params (dict): Additional parameters for the request.
+
+    Returns:
+        list[str]: proxy values of the form
+            '../uploads/{upload_id}/archive/{entry_id}#/data'
+    """
+    if len(sections) != len(file_names):
+        raise ValueError('Each section needs exactly one file name.')
+
+    endpoint = _RAW_ENDPOINT_TEMPLATE.format(
+        base_url=base_url, upload_id=upload_id, path=path
+    )
+
+    params['file_name'] = 'entries.zip'
+    if 'overwrite_if_exists' not in params:
+        params['overwrite_if_exists'] = True
+
+    # written to disk, so that only one serialized entry is held in memory at a time
+    with tempfile.TemporaryFile() as body:
+        with zipfile.ZipFile(body, 'w', zipfile.ZIP_STORED) as zip_file:
+            for section, file_name in zip(sections, file_names):
+                entry = (
+                    section
+                    if isinstance(section, EntryArchive)
+                    else EntryArchive(data=section)
+                )
+                zip_file.writestr(file_name, orjson.dumps(entry.m_to_dict()))
+
+        body.seek(0)
+        put_nomad_request(url=endpoint, data=body, params=params)
+
+    return [
+        get_reference(
+            upload_id=upload_id,
+            entry_id=generate_entry_id(upload_id, posixpath.join(path, file_name)),
+        )
+        for file_name in file_names
+    ]
+
+
 def put_nomad_request(
     url: str,
     data: Any = None,
     json_dict: dict = None,
     params: dict = None,
     timeout: int = None,
-) -> json:
+) -> Any:
     """
     Sends a put request to the NOMAD API.
 
@@ -188,26 +357,38 @@ def put_nomad_request(
         timeout (int, optional): Timeout for the request in seconds.
 
     Returns:
-        json: Response from the API in JSON serializable Python object.
+        Any: Response from the API in JSON serializable Python object.
     """
 
-    headers = {**Auth().headers()}
+    headers = {**_get_auth().headers()}
 
-    print(f'Sending post request @ {url}')
+    if data is None and json_dict is not None:
+        # serialized once and compactly to bytes instead of by `requests`
+        data = orjson.dumps(json_dict)
+        headers['Content-Type'] = 'application/json'
 
-    response = requests.put(
+    logger.debug('Sending PUT request @ %s', url)
+
+    response = _get_session().put(
         url,
         headers=headers,
-        json=json_dict,
         params=params,
         data=data,
         timeout=timeout,
     )
 
+    try:
+        payload = orjson.loads(response.content) if response.content else None
+    except ValueError:
+        if response.ok:
+            raise
+        # error pages of proxies in front of the API are not necessarily JSON
+        payload = response.text
+
     if not response.ok:
-        raise ValueError(f'Unexpected response {response.json()}')
+        raise ValueError(f'Unexpected response {payload}')
 
-    return response.json()
+    return payload
 
 
 def create_unique_filename(
@@ -217,21 +398,27 @@ def create_unique_filename(
 ):
     """
     Create a unique filename of the form '{prefix}_{iterator}.{suffix}'. If the filename
-    already exists, the iterator is incremented until a unique filename is found.
+    already exists, the iterator is doubled until a free one is found and the gap is
+    then bisected. When the iterators are used contiguously, this gives the smallest
+    free one with a logarithmic number of existence checks.
 
     Args:
         archive: The archive object.
         prefix: Part of the filename before the iterator. Default is 'Unnamed'.
         suffix: Usually the file extension. Default is 'archive.json'.
     """
-    i = 0
-
-    def template(i):
-        return f'{prefix}_{i}.{suffix}'
-
-    if not archive.m_context.raw_path_exists(template(i)):
-        return template(i)
-    while True:
-        i += 1
-        if not archive.m_context.raw_path_exists(template(i)):
-            return template(i)
+    exists = archive.m_context.raw_path_exists
+    if not exists(f'{prefix}_0.{suffix}'):
+        return f'{prefix}_0.{suffix}'
+
+    # `taken` always exists and `free` never does
+    taken, free = 0, 1
+    while exists(f'{prefix}_{free}.{suffix}'):
+        taken, free = free, free * 2
+    while free - taken > 1:
+        middle = (taken + free) // 2
+        if exists(f'{prefix}_{middle}.{suffix}'):
+            taken = middle
+        else:
+            free = middle
+    return f'{prefix}_{free}.{suffix}'
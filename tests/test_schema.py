@@ -17,8 +17,20 @@
 #
 
 import os.path
+from types import SimpleNamespace
 
+import nbformat as nbf
+import pytest
 from nomad.client import normalize_all, parse
+from nomad.datamodel.metainfo.basesections import SectionReference
+from nomad.utils import get_logger
+
+from nomad_analysis.jupyter.schema import (
+    ELNJupyterAnalysis,
+    ReferencedEntry,
+    get_unique_reference_indices,
+    normalize_m_proxy_value,
+)
 
 
 def test_schema(capture_error_from_logger, clean_up):
@@ -28,3 +40,253 @@ def test_schema(capture_error_from_logger, clean_up):
 
     assert entry_archive.data.analysis_type == 'Generic'
     # TODO: Add tests for generated jupyter notebook
+
+
+class RawFileContext:
+    """
+    Minimal stand-in for the archive context, backed by a directory of raw files.
+    """
+
+    def __init__(self, raw_path):
+        self._raw_path = str(raw_path)
+        self.updated_files = []
+
+    def raw_path(self):
+        return self._raw_path
+
+    def raw_path_exists(self, path):
+        return os.path.exists(os.path.join(self._raw_path, path))
+
+    def raw_file(self, path, mode='r'):
+        # like `StagingUploadFiles.raw_file`, missing files raise a KeyError
+        try:
+            return open(os.path.join(self._raw_path, path), mode, encoding='utf-8')
+        except FileNotFoundError as e:
+            raise KeyError(path) from e
+
+    def process_updated_raw_file(self, path, allow_modify=False):
+        self.updated_files.append(path)
+
+
+def create_notebook_analysis(tmp_path, entry_id='entry_1'):
+    archive = SimpleNamespace(entry_id=entry_id, m_context=RawFileContext(tmp_path))
+    analysis = ELNJupyterAnalysis(notebook='test_notebook.ipynb')
+    analysis.generate_jupyter_notebook(archive, get_logger(__name__))
+    return analysis, archive
+
+
+def read_notebook(archive, file_name):
+    with archive.m_context.raw_file(file_name, 'r') as nb_file:
+        return nbf.read(nb_file, as_version=nbf.NO_CONVERT)
+
+
+def write_notebook(archive, file_name, nb):
+    with archive.m_context.raw_file(file_name, 'w') as nb_file:
+        nbf.write(nb, nb_file)
+
+
+def test_overwrite_unchanged_notebook(tmp_path):
+    analysis, archive = create_notebook_analysis(tmp_path)
+    nb_path = os.path.join(str(tmp_path), analysis.notebook)
+    with open(nb_path, encoding='utf-8') as nb_file:
+        content = nb_file.read()
+
+    analysis.overwrite_jupyter_notebook(archive, get_logger(__name__))
+
+    assert archive.m_context.updated_files == [analysis.notebook]
+    with open(nb_path, encoding='utf-8') as nb_file:
+        assert nb_file.read() == content
+
+
+def test_overwrite_replaces_untouched_predefined_cells(tmp_path):
+    analysis, archive = create_notebook_analysis(tmp_path)
+    nb = read_notebook(archive, analysis.notebook)
+    count = nb.metadata['nomad_analysis']['predefined_cells']
+    nb.cells.append(nbf.v4.new_code_cell(source='user_code = 1'))
+    write_notebook(archive, analysis.notebook, nb)
+
+    archive.entry_id = 'entry_2'
+    analysis.overwrite_jupyter_notebook(archive, get_logger(__name__))
+
+    new_nb = read_notebook(archive, analysis.notebook)
+    predefined = analysis.write_predefined_cells(archive, get_logger(__name__))
+    assert [cell.source for cell in new_nb.cells[:count]] == [
+        cell.source for cell in predefined
+    ]
+    assert 'entry_2' in new_nb.cells[1].source
+    assert [cell.source for cell in new_nb.cells[count:]] == [
+        cell.source for cell in nb.cells[count:]
+    ]
+
+
+def test_overwrite_edited_predefined_cells(tmp_path):
+    analysis, archive = create_notebook_analysis(tmp_path)
+    nb = read_notebook(archive, analysis.notebook)
+    nb.cells[1].source += '\nedited = True\n'
+    nb.cells.insert(1, nbf.v4.new_code_cell(source='user_code = 1'))
+    write_notebook(archive, analysis.notebook, nb)
+
+    analysis.overwrite_jupyter_notebook(archive, get_logger(__name__))
+
+    new_nb = read_notebook(archive, analysis.notebook)
+    predefined = analysis.write_predefined_cells(archive, get_logger(__name__))
+    count = len(predefined)
+    assert [cell.source for cell in new_nb.cells[:count]] == [
+        cell.source for cell in predefined
+    ]
+    assert all('edited = True' not in cell.source for cell in new_nb.cells)
+    user_cells = [cell.source for cell in new_nb.cells[count:]]
+    assert user_cells == ['user_code = 1', '', '', '']
+    assert archive.m_context.updated_files[-1] == analysis.notebook
+
+
+def query_for_inputs(*entry_ids):
+    return {
+        'data': [
+            {'entry_id': entry_id, 'upload_id': 'upload_1'} for entry_id in entry_ids
+        ]
+    }
+
+
+def patch_query_resolution(monkeypatch, resolvable=True):
+    resolved = []
+
+    def get_resolved_section(self, m_proxy_value, upload_id, archive, logger, **kwargs):
+        resolved.append(m_proxy_value)
+        if not resolvable:
+            return None
+        return {'name': m_proxy_value, 'lab_id': None}
+
+    monkeypatch.setattr(
+        ELNJupyterAnalysis,
+        'get_upload_context',
+        lambda self, upload_id, archive, logger: object(),
+    )
+    monkeypatch.setattr(
+        ELNJupyterAnalysis, 'get_resolved_section', get_resolved_section
+    )
+    return resolved
+
+
+def test_unchanged_query_is_not_resolved_again(monkeypatch):
+    resolved = patch_query_resolution(monkeypatch)
+    analysis = ELNJupyterAnalysis(
+        reset_notebook=False, query_for_inputs=query_for_inputs('entry_1')
+    )
+    logger = get_logger(__name__)
+
+    assert len(analysis.process_changed_query_for_inputs(None, logger)) == 1
+    assert analysis.process_changed_query_for_inputs(None, logger) == []
+    assert len(resolved) == 1
+
+    analysis.query_for_inputs = query_for_inputs('entry_1', 'entry_2')
+    assert len(analysis.process_changed_query_for_inputs(None, logger)) == 2  # noqa: PLR2004
+    assert len(resolved) == 3  # noqa: PLR2004
+
+
+def test_unresolved_query_entries_are_retried(monkeypatch):
+    resolved = patch_query_resolution(monkeypatch, resolvable=False)
+    analysis = ELNJupyterAnalysis(
+        reset_notebook=False, query_for_inputs=query_for_inputs('entry_1')
+    )
+    logger = get_logger(__name__)
+
+    assert analysis.process_changed_query_for_inputs(None, logger) == []
+    assert analysis.query_for_inputs_fingerprint is None
+    analysis.process_changed_query_for_inputs(None, logger)
+    assert len(resolved) == 2  # noqa: PLR2004
+
+
+def test_referenced_query_entries_are_skipped():
+    analysis = ELNJupyterAnalysis(
+        query_for_inputs=query_for_inputs('entry_1', 'entry_2', 'entry_3'),
+        inputs=[
+            SectionReference(reference='../uploads/upload_1/archive/entry_1#data'),
+            SectionReference(reference='../uploads/upload_1/archive/entry_3#/data'),
+        ],
+    )
+
+    assert list(analysis.iter_new_query_entries()) == [('upload_1', 'entry_2')]
+
+
+def test_notebook_name_without_entry_name(tmp_path):
+    archive = SimpleNamespace(entry_id='entry_1', m_context=RawFileContext(tmp_path))
+    analysis = ELNJupyterAnalysis(notebook='test_generic_notebook.ipynb')
+    with archive.m_context.raw_file(analysis.notebook, 'w') as nb_file:
+        nbf.write(nbf.v4.new_notebook(), nb_file)
+
+    analysis.set_jupyter_notebook_name(archive, get_logger(__name__))
+    assert analysis.notebook == 'untitled_0.ipynb'
+    assert archive.m_context.raw_path_exists('untitled_0.ipynb')
+
+    analysis.set_jupyter_notebook_name(archive, get_logger(__name__))
+    assert analysis.notebook == 'untitled_0.ipynb'
+    assert archive.m_context.updated_files == ['untitled_0.ipynb']
+
+
+@pytest.mark.parametrize(
+    'm_proxy_value, expected',
+    [
+        ('../uploads/1234/archive/5678#data', '../uploads/1234/archive/5678#/data'),
+        ('../uploads/1234/archive/5678#/data', '../uploads/1234/archive/5678#/data'),
+        ('../uploads/1234/archive/5678', '../uploads/1234/archive/5678'),
+    ],
+)
+def test_normalize_m_proxy_value(m_proxy_value, expected):
+    assert normalize_m_proxy_value(m_proxy_value) == expected
+
+
+def test_overwrite_notebook_without_manifest(tmp_path):
+    analysis, archive = create_notebook_analysis(tmp_path)
+    nb = read_notebook(archive, analysis.notebook)
+    # without the manifest, the pre-defined cells are filtered by their prefix
+    del nb.metadata['nomad_analysis']
+    write_notebook(archive, analysis.notebook, nb)
+    analysis.overwrite_jupyter_notebook(archive, get_logger(__name__))
+    assert len(archive.m_context.updated_files) == 2  # noqa: PLR2004
+
+    analysis.overwrite_jupyter_notebook(archive, get_logger(__name__))
+    assert len(archive.m_context.updated_files) == 2  # noqa: PLR2004
+
+
+def test_get_unique_reference_indices():
+    m_proxy_values = ['ref_1', 'ref_2', 'ref_1', 'ref_3', 'ref_4', 'ref_5']
+    lab_ids = ['lab_1', None, None, 'lab_1', None, None]
+
+    assert get_unique_reference_indices(m_proxy_values, lab_ids) == [0, 1, 4, 5]
+
+
+def test_normalize_input_references():
+    analysis = ELNJupyterAnalysis()
+    ref_list = []
+    for m_proxy_value, name in [
+        ('../uploads/upload_1/archive/entry_1#data', 'entry 1'),
+        ('../uploads/upload_1/archive/entry_1#/data', 'duplicate'),
+        ('../uploads/upload_1/archive/entry_2#/data', None),
+    ]:
+        ref = ReferencedEntry(name=name)
+        ref.m_proxy_value = m_proxy_value
+        ref_list.append(ref)
+
+    analysis.normalize_input_references(ref_list, get_logger(__name__))
+
+    assert [input_ref.reference.m_proxy_value for input_ref in analysis.inputs] == [
+        '../uploads/upload_1/archive/entry_1#/data',
+        '../uploads/upload_1/archive/entry_2#/data',
+    ]
+    assert [input_ref.name for input_ref in analysis.inputs] == ['entry 1', None]
+    assert all(input_ref.m_parent is analysis for input_ref in analysis.inputs)
+
+
+def test_write_jupyter_notebook(tmp_path):
+    archive = SimpleNamespace(entry_id='entry_1', m_context=RawFileContext(tmp_path))
+    analysis = ELNJupyterAnalysis(notebook='test_notebook.ipynb')
+
+    analysis.write_jupyter_notebook(archive, get_logger(__name__))
+    assert archive.m_context.raw_path_exists(analysis.notebook)
+
+    archive.entry_id = 'entry_2'
+    analysis.write_jupyter_notebook(archive, get_logger(__name__))
+    nb = read_notebook(archive, analysis.notebook)
+    assert 'entry_2' in nb.cells[1].source
+    assert len(nb.cells) == nb.metadata['nomad_analysis']['predefined_cells'] + 3
@@ -0,0 +1,159 @@
+#
+# Copyright The NOMAD Authors.
+#
+# This file is part of NOMAD. See https://nomad-lab.eu for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import json
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+from nomad.utils import generate_entry_id
+
+from nomad_analysis import analysis_source, utils
+from nomad_analysis.jupyter.schema import ELNJupyterAnalysis
+from nomad_analysis.utils import get_function_source, list_to_string
+
+
+@pytest.mark.parametrize('category_name', ['Generic', 'XRD'])
+def test_get_function_source_returns_fresh_list(category_name):
+    uncached = get_function_source(category_name=category_name, module=analysis_source)
+    sources = get_function_source(category_name=category_name)
+
+    assert sources == uncached
+    assert sources
+    assert all(not source.startswith('@category') for source in sources)
+
+    sources.clear()
+    assert get_function_source(category_name=category_name) == uncached
+
+
+@pytest.mark.parametrize(
+    'list_instance, expected',
+    [
+        ([], ''),
+        (['a'], 'a\n'),
+        (['a', 'b\n', 'c'], 'a\nb\n\nc\n'),
+    ],
+)
+def test_list_to_string(list_instance, expected):
+    assert list_to_string(list_instance) == expected
+
+
+def test_create_entries_with_api(monkeypatch):
+    requests = []
+
+    def put_nomad_request(url, data=None, json_dict=None, params=None, timeout=None):
+        requests.append((url, data.read(), params))
+        return {}
+
+    monkeypatch.setattr(utils, 'put_nomad_request', put_nomad_request)
+    sections = [
+        ELNJupyterAnalysis(name='analysis 1'),
+        ELNJupyterAnalysis(name='analysis 2'),
+    ]
+    file_names = ['analysis_1.archive.json', 'analysis_2.archive.json']
+
+    references = utils.create_entries_with_api(
+        sections, 'http://nomad/api/v1', 'upload_1', file_names, path='results'
+    )
+
+    assert len(requests) == 1
+    url, data, params = requests[0]
+    assert url == 'http://nomad/api/v1/uploads/upload_1/raw/results'
+    assert params['file_name'] == 'entries.zip'
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        assert zip_file.namelist() == file_names
+        archive = json.loads(zip_file.read(file_names[1]))
+    assert archive['data']['name'] == 'analysis 2'
+    assert references == [
+        f'../uploads/upload_1/archive/'
+        f'{generate_entry_id("upload_1", f"results/{file_name}")}#/data'
+        for file_name in file_names
+    ]
+
+
+def test_put_nomad_request_json_body(monkeypatch):
+    calls = []
+
+    class Response:
+        ok = True
+        content = b'{"status":"ok"}'
+
+        def json(self):
+            return json.loads(self.content)
+
+    def put(url, **kwargs):
+        calls.append(kwargs)
+        return Response()
+
+    monkeypatch.setattr(utils, '_get_session', lambda: SimpleNamespace(put=put))
+    monkeypatch.setattr(utils, '_get_auth', lambda: SimpleNamespace(headers=dict))
+
+    response = utils.put_nomad_request(
+        'http://nomad/api/v1/uploads', json_dict={'data': {'name': 'entry'}}
+    )
+
+    assert response == {'status': 'ok'}
+    assert calls[0]['data'] == b'{"data":{"name":"entry"}}'
+    assert calls[0]['headers']['Content-Type'] == 'application/json'
+
+
+@pytest.mark.parametrize(
+    'existing, expected',
+    [
+        (set(), 'unnamed_0.archive.json'),
+        ({0}, 'unnamed_1.archive.json'),
+        (set(range(5)), 'unnamed_5.archive.json'),
+        (set(range(64)), 'unnamed_64.archive.json'),
+        (set(range(100)), 'unnamed_100.archive.json'),
+    ],
+)
+def test_create_unique_filename(existing, expected):
+    files = {f'unnamed_{i}.archive.json' for i in existing}
+    archive = SimpleNamespace(
+        m_context=SimpleNamespace(raw_path_exists=files.__contains__)
+    )
+
+    assert utils.create_unique_filename(archive) == expected
+
+
+def test_iter_function_source():
+    sources = utils.iter_function_source(category_name='XRD')
+
+    assert next(sources) == get_function_source(category_name='XRD')[0]
+    assert list(utils.iter_function_source(category_name='Unknown')) == []
+
+
+def test_put_nomad_request_error_body(monkeypatch):
+    class Response:
+        ok = False
+        content = b'<html>Bad Gateway</html>'
+        text = content.decode()
+
+        def json(self):
+            return json.loads(self.content)
+
+    monkeypatch.setattr(
+        utils,
+        '_get_session',
+        lambda: SimpleNamespace(put=lambda url, **kwargs: Response()),
+    )
+    monkeypatch.setattr(utils, '_get_auth', lambda: SimpleNamespace(headers=dict))
+
+    with pytest.raises(ValueError, match='Bad Gateway'):
+        utils.put_nomad_request('http://nomad/api/v1/uploads', data=b'')